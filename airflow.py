@@ -26,6 +26,10 @@ USEC_PER_ROW = 1024000 / 2
 USEC_PER_COL = int(USEC_PER_ROW / 64)
 USEC_PER_ROW = USEC_PER_COL * 64  # fix any rounding errors
 
+# Packet fields used by _main().
+FIELDS = ['type', 'airtime_usec', 'ta', 'pcap_secs', 'mac_usecs', 'flags',
+          'ssid']
+
 
 def _main(aliases):
   """Main program."""
@@ -36,8 +40,11 @@ def _main(aliases):
   real_macs = set()
   abbrevs = {}
   abbrev_queue = list(reversed(string.ascii_uppercase))
+  # MAC addresses are integers until we need to print them.
+  macs = wifipacket.MacTable('int')
 
-  for opt, unused_frame in wifipacket.Packetize(sys.stdin):
+  for opt, unused_frame in wifipacket.Packetize(sys.stdin, fields=FIELDS,
+                                                macs=macs):
     # TODO(apenwarr): handle control frame timing more carefully
     if opt.type & 0xf0 == 0x10:
       continue
@@ -60,7 +67,7 @@ def _main(aliases):
       ssid = opt.get('ssid')
       if ssid:
         ssid = re.sub(r'[^\w]', '.', ssid)
-        aliases.BetterGuess(ta, ssid)
+        aliases.BetterGuess(macs.Format(ta), ssid)
 
     if not time_init:
       col_start_usec = row_start_usec = mac_usecs
@@ -74,7 +81,7 @@ def _main(aliases):
           print
           print '--- .=Beacon ',
           for mac in row_macs:
-            nice_mac = aliases.Get(mac)
+            nice_mac = aliases.Get(macs.Format(mac))
             abbrev = abbrevs.get(mac, '')
             print '%s=%s' % (abbrev, nice_mac),
           print
@@ -90,12 +97,12 @@ def _main(aliases):
         airtime = p.get('airtime_usec', 0)
         if ta in real_macs and airtime > most_airtime[0]:
           most_airtime = airtime, ta, p.type
-      if not most_airtime[1]:
+      if most_airtime[1] is None:
         c = ' '
       elif most_airtime[1] in abbrevs:
         c = abbrevs[most_airtime[1]]
       else:
-        mac = most_airtime[1]
+        mac = macs.Format(most_airtime[1])
         try:
           nice_mac = aliases.Get(mac)
         except KeyError:
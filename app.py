@@ -41,6 +41,9 @@ ALL_FIELDS = [
     'pcap_secs', 'mac_usecs', 'ta', 'ra', 'antenna',
     'duration', 'orig_len', 'powerman'] + AVAIL_FIELDS
 
+# Packet fields used by _Boxes().
+BOXES_FIELDS = ['flags', 'ta', 'ra']
+
 IS_DEBUG = False
 SAMPLE_SIZE = 2
 
@@ -159,14 +162,17 @@ def _Boxes(blob_info):
 
   if not boxes:
     reader = blob_info.open()
-    boxes = collections.defaultdict(lambda: 0)
+    counts = collections.defaultdict(lambda: 0)
+    macs = wifipacket.MacTable()
     # TODO(katepek): use cache here instead if available
-    for p, unused_frame in wifipacket.Packetize(reader):
+    for p, unused_frame in wifipacket.Packetize(reader, fields=BOXES_FIELDS,
+                                                macs=macs):
       if 'flags' in p and p.flags & wifipacket.Flags.BAD_FCS: continue
       if 'ta' in p and 'ra' in p:
-        boxes[p.ta] += 1
-        boxes[p.ra] += 1
-    memcache.set(key=str(blob_info.key()), value=dict(boxes),
+        counts[p.ta] += 1
+        counts[p.ra] += 1
+    boxes = dict((macs.Format(mac), n) for mac, n in counts.iteritems())
+    memcache.set(key=str(blob_info.key()), value=boxes,
                  namespace='boxes')
   return boxes
 
@@ -301,7 +307,8 @@ def _MaybeCache(blob_info, pcapdata, start_time, end_time):
   start_times = []
   groups = []
   pairs = set()
-  for i, (p, unused_frame) in enumerate(wifipacket.Packetize(reader)):
+  for i, (p, unused_frame) in enumerate(
+      wifipacket.Packetize(reader, fields=ALL_FIELDS)):
     if IS_DEBUG and i > SAMPLE_SIZE:
       print 'Done', i
       break
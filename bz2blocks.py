@@ -0,0 +1,331 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Decompress bzip2 files one block at a time, in parallel.
+
+Each bzip2 block starts with a 48-bit magic number and can be decoded
+independently of the others, but blocks aren't byte-aligned.  We find the
+block (and end-of-stream) markers at any bit offset, then wrap each block
+in a minimal single-block bzip2 stream of its own, which a worker process
+can hand to bz2.decompress().
+
+In rare cases, the block or end-of-stream magic number can also appear
+inside compressed data.  The truncated real block before a false marker
+won't decompress, so when a block fails we extend it to the next marker
+(of either kind) after its end, and try again until it works.
+"""
+
+import binascii
+import bz2
+import collections
+import mmap
+import multiprocessing
+import os
+
+BLOCK_MAGIC = 0x314159265359
+EOS_MAGIC = 0x177245385090
+
+
+def _Patterns(magic):
+  """Return a list of (shift, pattern, first_mask, last_mask) for magic.
+
+  For each possible bit offset (shift) of the 48-bit magic number within a
+  byte, pattern is the sequence of bytes it fully covers, and the masks say
+  which bits of the partially covered bytes before and after belong to it.
+  """
+  out = [(0, binascii.unhexlify('%012x' % magic), 0, 0)]
+  for shift in xrange(1, 8):
+    window = binascii.unhexlify('%014x' % (magic << (8 - shift)))
+    out.append((shift, window[1:6],
+                (1 << (8 - shift)) - 1,
+                (0xff << (8 - shift)) & 0xff))
+  return out
+
+
+_BLOCK_PATTERNS = _Patterns(BLOCK_MAGIC)
+_EOS_PATTERNS = _Patterns(EOS_MAGIC)
+
+
+class _MarkerScanner(object):
+  """Finds all the block and end-of-stream markers in a bzip2 file.
+
+  Markers are returned in order as (bit_offset, is_block) tuples.  If pos
+  is given, we start looking at that byte offset, so markers starting up to
+  7 bits before it may be found too.
+  """
+
+  def __init__(self, data, pos=0):
+    self.data = data
+    self.nexts = []  # [bit offset of next match, search pos, is_block, pat]
+    for is_block, patterns in ((True, _BLOCK_PATTERNS),
+                               (False, _EOS_PATTERNS)):
+      for pat in patterns:
+        self.nexts.append(self._Find(pos, is_block, pat))
+
+  def _Find(self, pos, is_block, pat):
+    """Return the first match of pat at or after byte pos."""
+    shift, pattern, first_mask, last_mask = pat
+    data = self.data
+    want = (BLOCK_MAGIC if is_block else EOS_MAGIC)
+    while 1:
+      p = data.find(pattern, pos)
+      if p < 0:
+        return [None, None, is_block, pat]
+      pos = p + 1
+      if not shift:
+        return [p * 8, pos, is_block, pat]
+      if p < 1 or p + 5 >= len(data):
+        continue
+      first = ord(data[p - 1]) & first_mask
+      last = ord(data[p + 5]) & last_mask
+      if (first == (want >> (40 + shift)) & first_mask and
+          last == ((want << (8 - shift)) & last_mask)):
+        return [(p - 1) * 8 + shift, pos, is_block, pat]
+
+  def Next(self):
+    """Return the next (bit_offset, is_block) marker, or None at EOF."""
+    best = None
+    for i, (bit, unused_pos, unused_is_block, unused_pat) in enumerate(
+        self.nexts):
+      if bit is not None and (best is None or bit < self.nexts[best][0]):
+        best = i
+    if best is None:
+      return None
+    bit, pos, is_block, pat = self.nexts[best]
+    self.nexts[best] = self._Find(pos, is_block, pat)
+    return bit, is_block
+
+
+def _Bits(data, start, end):
+  """Return the bits data[start:end] (bit offsets) as a long."""
+  first = start // 8
+  last = (end + 7) // 8
+  n = long(binascii.hexlify(data[first:last]), 16)
+  n >>= last * 8 - end
+  return n & ((1 << (end - start)) - 1)
+
+
+def DecompressBlock(args):
+  """Decompress one bzip2 block, given (bytes, start_bit, end_bit).
+
+  Returns the decompressed data, or None if it isn't a valid block.
+  """
+  data, start, end = args
+  nbits = end - start
+  if nbits < 48 + 32:
+    return None
+  n = _Bits(data, start, end)
+  # A stream containing just this block: the combined stream CRC of a
+  # single block is the same as the block's own CRC.
+  crc = (n >> (nbits - 48 - 32)) & 0xffffffff
+  n = (((n << 48) | EOS_MAGIC) << 32) | crc
+  nbits += 48 + 32
+  pad = -nbits % 8
+  n <<= pad
+  stream = 'BZh9' + binascii.unhexlify('%0*x' % ((nbits + pad) // 4, n))
+  try:
+    return bz2.decompress(stream)
+  except (IOError, EOFError, ValueError):
+    return None
+
+
+class ParallelBZ2File(object):
+  """A read-only file-like object that decompresses a .bz2 file in parallel.
+
+  Handles files made of several concatenated bzip2 streams, like the ones
+  produced by pbzip2.  At most readahead blocks (each up to 900k of
+  compressed data, and more uncompressed) are in flight at once.
+  """
+
+  def __init__(self, filename, processes=None, readahead=None):
+    self.name = filename
+    self.pool = None
+    self.pending = collections.deque()
+    f = open(filename, 'rb')
+    if not os.fstat(f.fileno()).st_size:
+      self.data = ''
+    else:
+      self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    f.close()
+    if self.data and self.data[:3] != 'BZh':
+      raise IOError('%s: not a bzip2 file' % filename)
+    self.scanner = _MarkerScanner(self.data)
+    self.marker = self.scanner.Next()
+    self.pool = multiprocessing.Pool(processes)
+    self.readahead = readahead or 2 * len(self.pool._pool)
+    self.outbuf = ''
+    self.outpos = 0
+
+  def _NextRange(self):
+    """Return the (start, end) bit offsets of the next block, or None."""
+    while self.marker and not self.marker[1]:
+      self.marker = self.scanner.Next()  # skip end-of-stream markers
+    if not self.marker:
+      return None
+    start = self.marker[0]
+    self.marker = self.scanner.Next()
+    end = self.marker[0] if self.marker else len(self.data) * 8
+    return start, end
+
+  def _Slice(self, start, end):
+    """Return (bytes, start, end) for a worker, with bits relative to bytes."""
+    base = start // 8
+    return self.data[base:(end + 7) // 8], start - base * 8, end - base * 8
+
+  def _Fill(self):
+    while len(self.pending) < self.readahead:
+      r = self._NextRange()
+      if not r:
+        break
+      self.pending.append(
+          (r, self.pool.apply_async(DecompressBlock, (self._Slice(*r),))))
+
+  def _NextBlock(self):
+    """Return the next decompressed block, or None at EOF."""
+    self._Fill()
+    if not self.pending:
+      return None
+    (start, end), result = self.pending.popleft()
+    out = result.get()
+    if out is None:
+      out, end = self._Recover(start, end)
+      # Forget the ranges we swallowed, including ones not started yet.
+      while self.pending and self.pending[0][0][0] < end:
+        self.pending.popleft()
+      while self.marker and self.marker[0] < end:
+        self.marker = self.scanner.Next()
+    self._Fill()
+    return out
+
+  def _Recover(self, start, end):
+    """Decompress a block that was cut short by a false marker at end.
+
+    Returns (data, new_end).
+    """
+    scanner = _MarkerScanner(self.data, end // 8 + 1)
+    while 1:
+      marker = scanner.Next()
+      if not marker:
+        raise IOError('%s: invalid bzip2 data at bit %d'
+                      % (self.name, start))
+      if marker[0] <= end:
+        continue
+      end = marker[0]
+      out = DecompressBlock(self._Slice(start, end))
+      if out is not None:
+        return out, end
+
+  def read(self, n=-1):
+    out = []
+    got = 0
+    while n < 0 or got < n:
+      if self.outpos >= len(self.outbuf):
+        self.outbuf = self._NextBlock()
+        self.outpos = 0
+        if self.outbuf is None:
+          self.outbuf = ''
+          self.close()
+          break
+      want = len(self.outbuf) - self.outpos
+      if n >= 0:
+        want = min(want, n - got)
+      if not self.outpos and want == len(self.outbuf):
+        out.append(self.outbuf)
+      else:
+        out.append(self.outbuf[self.outpos:self.outpos + want])
+      self.outpos += want
+      got += want
+    return ''.join(out)
+
+  def __del__(self):
+    self.close()
+
+  def close(self):
+    if self.pool:
+      self.pool.terminate()
+      self.pool.join()
+      self.pool = None
+    self.pending.clear()
+
+
+class SerialBZ2File(object):
+  """A read-only file-like object that decompresses a .bz2 file in order.
+
+  Unlike bz2.BZ2File in python 2, this doesn't stop at the end of the first
+  bzip2 stream, so files made by pbzip2 come out the same as they do from
+  ParallelBZ2File.
+  """
+
+  def __init__(self, filename, blocksize=1024 * 1024):
+    self.name = filename
+    self.file = open(filename, 'rb')
+    self.blocksize = blocksize
+    self.decompressor = bz2.BZ2Decompressor()
+    self.in_stream = False
+    self.unused = ''
+    self.outbuf = ''
+    self.outpos = 0
+
+  def _NextBlock(self):
+    """Return the next piece of decompressed data, or None at EOF."""
+    while 1:
+      b = self.unused or self.file.read(self.blocksize)
+      self.unused = ''
+      if not b:
+        if self.in_stream:
+          try:
+            self.decompressor.decompress('')
+          except EOFError:
+            return None  # the last stream ended exactly at EOF
+          raise EOFError('%s: compressed file ended before the logical '
+                         'end-of-stream was detected' % self.name)
+        return None
+      try:
+        out = self.decompressor.decompress(b)
+      except EOFError:
+        # The previous stream ended exactly at the end of a read; this is
+        # the start of the next one.
+        self.decompressor = bz2.BZ2Decompressor()
+        out = self.decompressor.decompress(b)
+      self.in_stream = True
+      if self.decompressor.unused_data:
+        self.unused = self.decompressor.unused_data
+        self.decompressor = bz2.BZ2Decompressor()
+        self.in_stream = False
+      if out:
+        return out
+
+  def read(self, n=-1):
+    out = []
+    got = 0
+    while n < 0 or got < n:
+      if self.outpos >= len(self.outbuf):
+        self.outbuf = self._NextBlock()
+        self.outpos = 0
+        if self.outbuf is None:
+          self.outbuf = ''
+          break
+      want = len(self.outbuf) - self.outpos
+      if n >= 0:
+        want = min(want, n - got)
+      if not self.outpos and want == len(self.outbuf):
+        out.append(self.outbuf)
+      else:
+        out.append(self.outbuf[self.outpos:self.outpos + want])
+      self.outpos += want
+      got += want
+    return ''.join(out)
+
+  def close(self):
+    self.file.close()
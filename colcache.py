@@ -0,0 +1,404 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A columnar on-disk cache of the packets decoded from a capture.
+
+Decoding a big capture takes a while, and every tool does it again from
+scratch.  Instead, a capture can be decoded once into a sidecar file (see
+CacheFilename) holding one typed array per field, which later loads
+instantly with mmap.
+
+The file starts with _MAGIC, then has a series of chunks of up to
+chunk_packets packets each.  A chunk is one array per column (in the order
+of COLUMNS, each 8-byte aligned), and its first and last pcap_secs are
+recorded so a time range can skip whole chunks.  A column that is missing
+from every packet in a chunk isn't stored at all.  Strings (typestr, ssid)
+and MAC addresses are dictionary-encoded: the column holds 1 + an index
+into a table, or 0 if the field was missing.  Missing numbers are NaN, or
+the smallest value of their type.  The tables and the location of every
+array are in a JSON trailer at the end, followed by its length and _MAGIC
+again.
+
+The trailer records wifipacket.PARSER_VERSION and the capture's size and
+mtime; LoadFor() ignores the cache if any of them have changed.
+
+This needs numpy.  If it isn't available, Available() returns false and
+callers should fall back to wifipacket.Packetize().
+"""
+
+import binascii
+import json
+import mmap
+import os
+import struct
+import wifipacket
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+class Error(Exception):
+  pass
+
+
+VERSION = 1
+
+_MAGIC = 'WDCOLS1\n'
+_TRAILER = struct.Struct('<Q8s')
+
+# (name, dtype) for each cached Packet field.  dtype 'str' and 'mac' are
+# dictionary-encoded.  The tuple-valued radiotap fields, beacon tags, and
+# aid aren't cached.
+COLUMNS = [
+    ('pcap_secs', 'f8'),
+    ('incl_len', 'u4'),
+    ('orig_len', 'u4'),
+    ('mac_usecs', 'i8'),
+    ('airtime_usec', 'f8'),
+    ('rate', 'f8'),
+    ('flags', 'i2'),
+    ('bad', 'i1'),
+    ('freq', 'i4'),
+    ('channel_flags', 'i4'),
+    ('mcs', 'i2'),
+    ('spatialstreams', 'i2'),
+    ('bw', 'i2'),
+    ('dbm_antsignal', 'i2'),
+    ('dbm_antnoise', 'i2'),
+    ('db_antsignal', 'i2'),
+    ('db_antnoise', 'i2'),
+    ('lock_quality', 'i4'),
+    ('tx_attenuation', 'i4'),
+    ('db_tx_attenuation', 'i2'),
+    ('dbm_tx_power', 'i2'),
+    ('antenna', 'i2'),
+    ('rx_flags', 'i4'),
+    ('tx_flags', 'i4'),
+    ('rts_retries', 'i2'),
+    ('data_retries', 'i2'),
+    ('type', 'i2'),
+    ('dsmode', 'i1'),
+    ('retry', 'i1'),
+    ('powerman', 'i1'),
+    ('order', 'i1'),
+    ('duration', 'i4'),
+    ('seq', 'i4'),
+    ('frag', 'i2'),
+    ('typestr', 'str'),
+    ('ssid', 'str'),
+    ('ta', 'mac'),
+    ('ra', 'mac'),
+    ('xa', 'mac'),
+]
+COLUMN_NAMES = [name for name, unused_dtype in COLUMNS]
+_DTYPES = dict(COLUMNS)
+
+
+def Available():
+  """Return true if numpy is available, so we can read and write caches."""
+  return numpy is not None
+
+
+def _StorageType(dtype):
+  return 'u4' if dtype in ('str', 'mac') else dtype
+
+
+def _Missing(dtype):
+  """Return the value stored for a missing field of the given dtype."""
+  if dtype in ('str', 'mac'):
+    return 0
+  dt = numpy.dtype(dtype)
+  if dt.kind == 'f':
+    return numpy.nan
+  elif dt.kind == 'i':
+    return numpy.iinfo(dt).min
+  return None  # required field
+
+
+class _ChunkWriter(object):
+  """Accumulates packets and writes them out as chunks of columns."""
+
+  def __init__(self, f, chunk_packets):
+    self.f = f
+    self.chunk_packets = chunk_packets
+    self.rows = []
+    self.macs = wifipacket.MacTable('id')
+    self.strings = dict((name, {}) for name, dtype in COLUMNS
+                        if dtype == 'str')
+    self.chunks = []
+
+  def Add(self, opt):
+    self.rows.append(tuple(opt.get(name) for name in COLUMN_NAMES))
+    if len(self.rows) >= self.chunk_packets:
+      self.Flush()
+
+  def _Encode(self, name, dtype, values):
+    if dtype == 'mac':
+      return [0 if v is None else v + 1 for v in values]
+    elif dtype == 'str':
+      table = self.strings[name]
+      out = []
+      for v in values:
+        if v is None:
+          out.append(0)
+        else:
+          code = table.get(v)
+          if code is None:
+            code = table[v] = len(table) + 1
+          out.append(code)
+      return out
+    missing = _Missing(dtype)
+    if missing is None:
+      return values
+    return [missing if v is None else v for v in values]
+
+  def Flush(self):
+    if not self.rows:
+      return
+    offsets = []
+    for (name, dtype), values in zip(COLUMNS, zip(*self.rows)):
+      if values.count(None) == len(values):
+        offsets.append(None)
+        continue
+      a = numpy.array(self._Encode(name, dtype, values),
+                      dtype=_StorageType(dtype))
+      pos = self.f.tell()
+      pad = wifipacket.Align(pos, 8) - pos
+      self.f.write('\0' * pad)
+      offsets.append(pos + pad)
+      self.f.write(a.tostring())
+    secs = [row[0] for row in self.rows]
+    self.chunks.append(dict(count=len(self.rows), offsets=offsets,
+                            min_time=min(secs), max_time=max(secs),
+                            first_time=secs[0]))
+    self.rows = []
+
+  def Trailer(self, st):
+    """Return the JSON trailer, given the os.stat() of the capture."""
+    strings = {}
+    for name, table in self.strings.iteritems():
+      values = [None] * len(table)
+      for v, code in table.iteritems():
+        values[code - 1] = binascii.hexlify(v)
+      strings[name] = values
+    return json.dumps(dict(
+        version=VERSION, parser_version=wifipacket.PARSER_VERSION,
+        file_size=st.st_size, mtime=st.st_mtime, columns=COLUMNS,
+        macs=[binascii.hexlify(raw) for raw in self.macs.addrs],
+        strings=strings, chunks=self.chunks))
+
+
+def CacheFilename(capture_filename):
+  """Return the name of the column cache sidecar file for a capture file."""
+  return capture_filename + '.cols'
+
+
+def BuildCache(capture_filename, chunk_packets=65536, filename=None):
+  """Decode a capture and save its column cache; return the ColumnCache.
+
+  The cache is saved as filename (default: CacheFilename(capture_filename)).
+  """
+  if not Available():
+    raise Error('colcache requires numpy')
+  filename = filename or CacheFilename(capture_filename)
+  tmpname = filename + '.tmp'
+  st = os.stat(capture_filename)
+  with open(tmpname, 'wb') as f:
+    f.write(_MAGIC)
+    writer = _ChunkWriter(f, chunk_packets)
+    stream = wifipacket.ZOpen(capture_filename)
+    try:
+      for opt, unused_frame in wifipacket.Packetize(stream,
+                                                    fields=COLUMN_NAMES,
+                                                    macs=writer.macs):
+        writer.Add(opt)
+    finally:
+      stream.close()
+    writer.Flush()
+    trailer = writer.Trailer(st)
+    f.write(trailer)
+    f.write(_TRAILER.pack(len(trailer), _MAGIC))
+  os.rename(tmpname, filename)
+  return ColumnCache.Load(filename)
+
+
+def _CheckCached(names):
+  """Raise Error if any of names isn't a cached column."""
+  for name in names:
+    if name not in _DTYPES:
+      raise Error('field %r is not cached' % name)
+
+
+class ColumnCache(object):
+  """A loaded column cache file.
+
+  Attributes:
+    macs: raw MAC addresses, for decoding the ta, ra, and xa columns.
+    strings: for each 'str' column, the list of its string values.
+    chunks: one dict per chunk, with its count, min_time and max_time.
+  """
+
+  def __init__(self, data, meta):
+    self.data = data
+    self.meta = meta
+    self.macs = [binascii.unhexlify(v) for v in meta['macs']]
+    self.strings = dict((name, [binascii.unhexlify(v) for v in values])
+                        for name, values in meta['strings'].iteritems())
+    self.chunks = meta['chunks']
+    self.count = sum(c['count'] for c in self.chunks)
+
+  def __len__(self):
+    return self.count
+
+  @staticmethod
+  def Load(filename):
+    if not Available():
+      raise Error('colcache requires numpy')
+    with open(filename, 'rb') as f:
+      size = os.fstat(f.fileno()).st_size
+      if size < len(_MAGIC) + _TRAILER.size:
+        raise Error('%s: too short for a column cache' % filename)
+      m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    trailer_len, magic = _TRAILER.unpack_from(m, size - _TRAILER.size)
+    if m[:len(_MAGIC)] != _MAGIC or magic != _MAGIC:
+      raise Error('%s: not a column cache' % filename)
+    start = size - _TRAILER.size - trailer_len
+    meta = json.loads(m[start:start + trailer_len])
+    if meta.get('version') != VERSION:
+      raise Error('%s: unknown column cache version %r'
+                  % (filename, meta.get('version')))
+    if [tuple(c) for c in meta['columns']] != COLUMNS:
+      raise Error('%s: unexpected columns' % filename)
+    return ColumnCache(m, meta)
+
+  @staticmethod
+  def LoadFor(capture_filename):
+    """Return the ColumnCache for a capture, or None if none is usable.
+
+    The cache is ignored if the capture's size or mtime have changed since
+    it was built, or if it was built by a different PARSER_VERSION.
+    """
+    if not Available():
+      return None
+    try:
+      cache = ColumnCache.Load(CacheFilename(capture_filename))
+      st = os.stat(capture_filename)
+    except (IOError, OSError, ValueError, Error):
+      return None
+    meta = cache.meta
+    if (meta['parser_version'] != wifipacket.PARSER_VERSION
+        or meta['file_size'] != st.st_size or meta['mtime'] != st.st_mtime):
+      return None
+    return cache
+
+  def _Column(self, chunk, name):
+    dtype = _StorageType(_DTYPES[name])
+    offset = chunk['offsets'][COLUMN_NAMES.index(name)]
+    if offset is None:
+      a = numpy.empty(chunk['count'], dtype=dtype)
+      a.fill(_Missing(_DTYPES[name]))
+      return a
+    return numpy.frombuffer(self.data, dtype=dtype, count=chunk['count'],
+                            offset=offset)
+
+  def Chunks(self, fields=None, start_time=None, end_time=None):
+    """Yield a dict of numpy arrays, one per field, for each chunk.
+
+    The arrays are read-only views of the file.  'str' and 'mac' columns
+    hold dictionary codes; see Values().  start_time and end_time select
+    packets like they do for wifipacket.Packetize(): from the first one at
+    or after start_time, until the first one after end_time.
+    """
+    names = COLUMN_NAMES if fields is None else fields
+    _CheckCached(names)
+    started = start_time is None
+    for chunk in self.chunks:
+      lo, hi = 0, chunk['count']
+      if not started:
+        if chunk['max_time'] < start_time:
+          continue
+        secs = self._Column(chunk, 'pcap_secs')
+        lo = int(numpy.argmax(secs >= start_time))
+        started = True
+      done = False
+      if end_time is not None:
+        if chunk['first_time'] > end_time:
+          return
+        if chunk['max_time'] > end_time:
+          after = numpy.nonzero(self._Column(chunk, 'pcap_secs')[lo:]
+                                > end_time)[0]
+          if len(after):
+            hi = lo + int(after[0])
+            done = True
+      if lo < hi:
+        yield dict((name, self._Column(chunk, name)[lo:hi])
+                   for name in names)
+      if done:
+        return
+
+  def Values(self, name, codes, macs=None):
+    """Return the list of values for the codes from a 'str' or 'mac' column.
+
+    Missing values are None.  MAC addresses are colon-hex strings, or if
+    macs is a wifipacket.MacTable, that table's values.
+    """
+    _CheckCached([name])
+    dtype = _DTYPES[name]
+    if dtype == 'str':
+      table = [None] + self.strings[name]
+    elif macs is None:
+      table = [None] + [wifipacket.MacAddr(raw) for raw in self.macs]
+    else:
+      table = [None] + [macs.Intern(raw) for raw in self.macs]
+    return [table[code] for code in codes.tolist()]
+
+  def Packetize(self, fields=None, start_time=None, end_time=None,
+                macs=None):
+    """Yield (opt, None) pairs like wifipacket.Packetize() would.
+
+    Each opt is a wifipacket.Struct of the requested fields (default: all
+    of COLUMN_NAMES), leaving out the ones missing from that packet.  There
+    are no frames, since the cache doesn't keep them.  macs is as for
+    Values().
+    """
+    names = COLUMN_NAMES if fields is None else fields
+    _CheckCached(names)
+    tables = {}
+    for name in names:
+      if _DTYPES.get(name) == 'str':
+        tables[name] = [None] + self.strings[name]
+      elif _DTYPES.get(name) == 'mac':
+        if 'mac' not in tables:
+          tables['mac'] = self.Values(name, numpy.arange(len(self.macs) + 1),
+                                      macs)
+        tables[name] = tables['mac']
+    missing = [(name, _Missing(_DTYPES[name])) for name in names]
+    for chunk in self.Chunks(names, start_time, end_time):
+      columns = []
+      for name, miss in missing:
+        values = chunk[name].tolist()
+        if name in tables:
+          table = tables[name]
+          values = [table[v] for v in values]
+        elif miss is not None:
+          if miss != miss:  # NaN
+            values = [None if v != v else v for v in values]
+          else:
+            values = [None if v == miss else v for v in values]
+        columns.append(values)
+      for row in zip(*columns):
+        yield wifipacket.Struct((name, v) for name, v in zip(names, row)
+                                if v is not None), None
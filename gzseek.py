@@ -0,0 +1,332 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Random access into gzip files, along the lines of zlib's zran.c.
+
+A deflate stream can't normally be decompressed from the middle, because
+each block can refer back to the previous 32k of output, and blocks don't
+start on byte boundaries.  So every so often while decompressing the whole
+file once, we save a checkpoint: the compressed offset (in bytes plus bits)
+of a block boundary, the uncompressed offset it corresponds to, and the
+preceding 32k of output.  Later, we can start inflating at any checkpoint
+by priming zlib with those bits and that window.
+
+Python's zlib module doesn't expose inflatePrime() or
+inflateSetDictionary() for raw streams, so we talk to libz through ctypes.
+If that isn't available, Available() returns false and callers should fall
+back to reading sequentially with gzip.GzipFile.
+"""
+
+import collections
+import os
+import struct
+import zlib
+
+try:
+  import ctypes
+  import ctypes.util
+except ImportError:
+  ctypes = None
+
+
+class Error(Exception):
+  pass
+
+
+WINDOW_SIZE = 32768
+CHUNK_SIZE = 65536
+
+_Z_OK = 0
+_Z_STREAM_END = 1
+_Z_BUF_ERROR = -5
+_Z_NO_FLUSH = 0
+_Z_BLOCK = 5
+
+_MAGIC = 'GZSEEK1\n'
+_HEADER = struct.Struct('<8sQI')
+_POINT = struct.Struct('<QQBI')
+
+Checkpoint = collections.namedtuple('Checkpoint', 'out in_ bits window')
+
+
+if ctypes:
+  class _ZStream(ctypes.Structure):
+    _fields_ = [
+        ('next_in', ctypes.c_void_p),
+        ('avail_in', ctypes.c_uint),
+        ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p),
+        ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p),
+        ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p),
+        ('zfree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int),
+        ('adler', ctypes.c_ulong),
+        ('reserved', ctypes.c_ulong),
+    ]
+
+
+_libz = None
+
+
+def _Libz():
+  """Load libz with ctypes, or raise Error."""
+  global _libz
+  if _libz is None:
+    name = ctypes and ctypes.util.find_library('z')
+    if not name:
+      raise Error('libz is not available through ctypes')
+    lib = ctypes.CDLL(name)
+    pstream = ctypes.POINTER(_ZStream)
+    lib.zlibVersion.restype = ctypes.c_char_p
+    lib.inflateInit2_.argtypes = [pstream, ctypes.c_int, ctypes.c_char_p,
+                                  ctypes.c_int]
+    lib.inflate.argtypes = [pstream, ctypes.c_int]
+    lib.inflateEnd.argtypes = [pstream]
+    lib.inflatePrime.argtypes = [pstream, ctypes.c_int, ctypes.c_int]
+    lib.inflateSetDictionary.argtypes = [pstream, ctypes.c_char_p,
+                                         ctypes.c_uint]
+    _libz = lib
+  return _libz
+
+
+def Available():
+  """Return true if we can do random access into gzip files here."""
+  try:
+    _Libz()
+  except (Error, OSError):
+    return False
+  return True
+
+
+class _Inflater(object):
+  """A thin wrapper around a libz inflate z_stream."""
+
+  def __init__(self, wbits):
+    self.lib = _Libz()
+    self.strm = _ZStream()
+    self.pending = ''
+    rc = self.lib.inflateInit2_(ctypes.byref(self.strm), wbits,
+                                self.lib.zlibVersion(),
+                                ctypes.sizeof(_ZStream))
+    if rc != _Z_OK:
+      raise Error('inflateInit2 failed: %d' % rc)
+
+  def __del__(self):
+    if getattr(self, 'lib', None):
+      self.lib.inflateEnd(ctypes.byref(self.strm))
+
+  def Prime(self, bits, value):
+    rc = self.lib.inflatePrime(ctypes.byref(self.strm), bits, value)
+    if rc != _Z_OK:
+      raise Error('inflatePrime failed: %d' % rc)
+
+  def SetDictionary(self, window):
+    rc = self.lib.inflateSetDictionary(ctypes.byref(self.strm), window,
+                                       len(window))
+    if rc != _Z_OK:
+      raise Error('inflateSetDictionary failed: %d' % rc)
+
+  def Inflate(self, flush, maxout):
+    """Inflate some of self.pending.
+
+    Returns (rc, consumed, output), removing the consumed bytes from
+    self.pending.
+    """
+    inp = self.pending
+    outbuf = ctypes.create_string_buffer(maxout)
+    strm = self.strm
+    strm.next_in = ctypes.cast(ctypes.c_char_p(inp), ctypes.c_void_p)
+    strm.avail_in = len(inp)
+    strm.next_out = ctypes.addressof(outbuf)
+    strm.avail_out = maxout
+    rc = self.lib.inflate(ctypes.byref(strm), flush)
+    if rc not in (_Z_OK, _Z_STREAM_END, _Z_BUF_ERROR):
+      raise Error('inflate failed: %d (%s)' % (rc, strm.msg))
+    consumed = len(inp) - strm.avail_in
+    self.pending = inp[consumed:]
+    return rc, consumed, outbuf.raw[:maxout - strm.avail_out]
+
+
+class GzipIndex(object):
+  """A list of Checkpoints allowing random access into a gzip file."""
+
+  def __init__(self, points, file_size=None):
+    self.points = points
+    self.file_size = file_size
+
+  @staticmethod
+  def Build(f, span=1024 * 1024):
+    """Decompress all of gzip file f, saving a checkpoint every span bytes."""
+    f.seek(0)
+    points = []
+    inf = _Inflater(47)  # 32 + 15: expect a gzip header
+    totin = totout = 0
+    last = None
+    window = ''
+    while 1:
+      if not inf.pending:
+        inf.pending = f.read(CHUNK_SIZE)
+        if not inf.pending:
+          break
+      rc, consumed, out = inf.Inflate(_Z_BLOCK, CHUNK_SIZE)
+      totin += consumed
+      totout += len(out)
+      window = (window + out)[-WINDOW_SIZE:]
+      if rc == _Z_STREAM_END:
+        # Concatenated gzip members are allowed; start a new one.
+        pending = inf.pending
+        inf = _Inflater(47)
+        inf.pending = pending
+        continue
+      if not consumed and not out:
+        break  # truncated file
+      dt = inf.strm.data_type
+      if ((dt & 128) and not (dt & 64)
+          and (last is None or totout - last > span)):
+        points.append(Checkpoint(totout, totin, dt & 7, window))
+        last = totout
+    return GzipIndex(points)
+
+  def Find(self, offset):
+    """Return the last Checkpoint at or before offset, or None."""
+    best = None
+    lo, hi = 0, len(self.points)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.points[mid].out <= offset:
+        best = self.points[mid]
+        lo = mid + 1
+      else:
+        hi = mid
+    return best
+
+  def Open(self, f, offset):
+    """Return a file-like object reading f's uncompressed data from offset."""
+    return GzipReader(f, self, offset)
+
+  def Save(self, filename):
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as f:
+      f.write(_HEADER.pack(_MAGIC, self.file_size or 0, len(self.points)))
+      for p in self.points:
+        window = zlib.compress(p.window)
+        f.write(_POINT.pack(p.out, p.in_, p.bits, len(window)))
+        f.write(window)
+    os.rename(tmpname, filename)
+
+  @staticmethod
+  def Load(filename):
+    with open(filename, 'rb') as f:
+      magic, file_size, npoints = _HEADER.unpack(f.read(_HEADER.size))
+      if magic != _MAGIC:
+        raise Error('%s: not a gzip index' % filename)
+      points = []
+      for _ in xrange(npoints):
+        out, in_, bits, wlen = _POINT.unpack(f.read(_POINT.size))
+        points.append(Checkpoint(out, in_, bits,
+                                 zlib.decompress(f.read(wlen))))
+    return GzipIndex(points, file_size)
+
+  @staticmethod
+  def LoadFor(gz_filename):
+    """Return the usable GzipIndex for the given file, or None."""
+    if not Available():
+      return None
+    try:
+      index = GzipIndex.Load(IndexFilename(gz_filename))
+      size = os.path.getsize(gz_filename)
+    except (IOError, OSError, struct.error, zlib.error, Error):
+      return None
+    if index.file_size != size:
+      return None
+    return index
+
+
+class GzipReader(object):
+  """A read-only file-like object for a gzip file, starting at an offset."""
+
+  def __init__(self, f, index, offset):
+    self.f = f
+    self.name = getattr(f, 'name', None)
+    point = index.Find(offset)
+    if point:
+      self.inf = _Inflater(-15)  # raw deflate, no header
+      if point.bits:
+        f.seek(point.in_ - 1)
+        self.inf.Prime(point.bits, ord(f.read(1)) >> (8 - point.bits))
+      else:
+        f.seek(point.in_)
+      self.inf.SetDictionary(point.window)
+      self.raw = True
+      self.pos = point.out
+    else:
+      f.seek(0)
+      self.inf = _Inflater(47)
+      self.raw = False
+      self.pos = 0
+    self.eof = False
+    while self.pos < offset:
+      if not self.read(min(offset - self.pos, CHUNK_SIZE)):
+        break
+
+  def read(self, n=-1):
+    out = []
+    got = 0
+    while (n < 0 or got < n) and not self.eof:
+      if not self.inf.pending:
+        self.inf.pending = self.f.read(CHUNK_SIZE)
+        if not self.inf.pending:
+          self.eof = True
+          break
+      want = CHUNK_SIZE if n < 0 else n - got
+      rc, consumed, b = self.inf.Inflate(_Z_NO_FLUSH, want)
+      out.append(b)
+      got += len(b)
+      if rc == _Z_STREAM_END:
+        pending = self.inf.pending
+        if self.raw:
+          # zlib didn't see the gzip header, so it won't skip the trailer.
+          pending += self.f.read(max(0, 8 - len(pending)))
+          pending = pending[8:]
+        self.inf = _Inflater(47)
+        self.inf.pending = pending
+        self.raw = False
+      elif not consumed and not b:
+        self.eof = True  # truncated stream
+    self.pos += got
+    return ''.join(out)
+
+  def tell(self):
+    return self.pos
+
+  def close(self):
+    self.f.close()
+
+
+def IndexFilename(gz_filename):
+  """Return the name of the GzipIndex sidecar file for a gzip file."""
+  return gz_filename + '.gzidx'
+
+
+def BuildIndex(gz_filename, span=1024 * 1024):
+  """Build and save a GzipIndex sidecar for a gzip file; return the index."""
+  with open(gz_filename, 'rb') as f:
+    index = GzipIndex.Build(f, span)
+  index.file_size = os.path.getsize(gz_filename)
+  index.Save(IndexFilename(gz_filename))
+  return index
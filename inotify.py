@@ -0,0 +1,126 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Wait for changes to files in a directory, using Linux inotify.
+
+Python 2 has no inotify module, so we talk to libc through ctypes.  If that
+isn't possible (eg. on MacOS), Available() returns false and callers should
+fall back to polling.
+"""
+
+import errno
+import os
+import select
+
+try:
+  import ctypes
+  import ctypes.util
+except ImportError:
+  ctypes = None
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+_libc = None
+
+
+def _Libc():
+  global _libc
+  if _libc is None:
+    _libc = False
+    if ctypes:
+      name = ctypes.util.find_library('c')
+      try:
+        lib = ctypes.CDLL(name, use_errno=True)
+        lib.inotify_init1.argtypes = [ctypes.c_int]
+        lib.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                          ctypes.c_uint32]
+        _libc = lib
+      except (OSError, AttributeError):
+        pass
+  return _libc
+
+
+def Available():
+  """Return true if we can use inotify here."""
+  return bool(_Libc())
+
+
+class Watcher(object):
+  """Watches one or more directories for changes to the files in them.
+
+  We don't report which files changed, just that something might have: the
+  caller is expected to look again at whatever it's interested in.
+  """
+
+  DEFAULT_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+  def __init__(self):
+    self.fd = None
+    libc = _Libc()
+    if not libc:
+      raise OSError(errno.ENOSYS, 'inotify is not available')
+    self.fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    if self.fd < 0:
+      e = ctypes.get_errno()
+      raise OSError(e, os.strerror(e))
+
+  def __del__(self):
+    self.close()
+
+  def Add(self, path, mask=DEFAULT_MASK):
+    """Start watching the directory (or file) path."""
+    if _Libc().inotify_add_watch(self.fd, path, mask) < 0:
+      e = ctypes.get_errno()
+      raise OSError(e, '%s: %s' % (path, os.strerror(e)))
+
+  def Wait(self, timeout=None):
+    """Wait up to timeout seconds (None: forever) for a change.
+
+    Returns true if something changed.
+    """
+    try:
+      r, _, _ = select.select([self.fd], [], [], timeout)
+    except select.error, e:
+      if e.args[0] != errno.EINTR:
+        raise
+      return True
+    if not r:
+      return False
+    # Throw away the events; there might be several, but one look is enough.
+    while 1:
+      try:
+        if not os.read(self.fd, 65536):
+          break
+      except OSError, e:
+        if e.errno != errno.EAGAIN:
+          raise
+        break
+    return True
+
+  def fileno(self):
+    return self.fd
+
+  def close(self):
+    if self.fd is not None and self.fd >= 0:
+      os.close(self.fd)
+    self.fd = None
@@ -92,3 +92,112 @@ class Buf(object):
 
   def __str__(self):
     return ''.join(bytes(i) for i in self._buflist)
+
+
+class RingBuf(object):
+  """A byte queue in one contiguous, growable bytearray.
+
+  It has the same API as Buf, plus Fill(), which reads from a stream
+  straight into the free space.  Bytes are added at one end and consumed
+  from the other; when the free space at the end runs out, the unread bytes
+  are moved back to the start, or into a bigger array if they don't fit.
+  Nothing is ever wrapped around, so any run of queued bytes can be viewed
+  or searched in place.
+
+  Because the space is reused, Get() returns a copy of the bytes; Peek()
+  returns a buffer, like Buf.Peek(), but it is only valid until the next
+  Put() or Fill().
+  """
+
+  def __init__(self, size=65536):
+    self._buf = bytearray(size)
+    self._view = memoryview(self._buf)
+    self._start = 0
+    self._end = 0
+    self.used = 0
+
+  def _Reserve(self, n):
+    """Make sure there are at least n free bytes after self._end."""
+    size = len(self._buf)
+    if size - self._end >= n:
+      return
+    used = self.used
+    if used + n <= size // 2 or (used + n <= size and self._start >= used):
+      # Only move things when it frees up plenty of space; otherwise we'd
+      # end up moving the same bytes over and over.  The ranges can
+      # overlap, so go through a copy.
+      self._buf[:used] = self._view[self._start:self._end].tobytes()
+    else:
+      newbuf = bytearray(max(size * 2, used + n))
+      newbuf[:used] = self._view[self._start:self._end]
+      self._buf = newbuf
+      self._view = memoryview(newbuf)
+    self._start = 0
+    self._end = used
+
+  def Put(self, b):
+    """Add the bytes from b to the end of the buffer."""
+    n = len(b)
+    if not n:
+      return
+    self._Reserve(n)
+    self._buf[self._end:self._end + n] = b
+    self._end += n
+    self.used += n
+
+  def Fill(self, stream, n=65536):
+    """Read up to n bytes from stream into the buffer.
+
+    Uses stream.readinto() if it has one, to avoid making a temporary
+    string.  Returns the number of bytes read; 0 means EOF.
+    """
+    readinto = getattr(stream, 'readinto', None)
+    if readinto is None:
+      b = stream.read(n)
+      self.Put(b)
+      return len(b)
+    self._Reserve(n)
+    got = readinto(self._view[self._end:self._end + n]) or 0
+    self._end += got
+    self.used += got
+    return got
+
+  def Peek(self, n):
+    """Retrieve the first n bytes from the buffer, without removing them."""
+    n = min(n, self.used)
+    return buffer(self._buf, self._start, n)
+
+  def Get(self, n):
+    """Retrieve the first n bytes from the buffer, removing them."""
+    n = min(n, self.used)
+    ret = self._view[self._start:self._start + n].tobytes()
+    self._start += n
+    self.used -= n
+    if not self.used:
+      self._start = self._end = 0
+    return ret
+
+  def GetAll(self):
+    """Return all bytes from the buffer, removing them."""
+    return self.Get(self.used)
+
+  def Pos(self, char):
+    """Return the number of bytes you'd have to Get() to find 'char'."""
+    p = self._buf.find(char, self._start, self._end)
+    if p < 0:
+      return 0
+    return p - self._start + 1
+
+  def GetUntil(self, char):
+    """Get() all the bytes up to and including char. If none, returns ''."""
+    return self.Get(self.Pos(char))
+
+  def IsEmpty(self):
+    """Returns true if the buffer has no bytes remaining."""
+    return not self.used
+
+  def __repr__(self):
+    return 'RingBuf(%r)' % str(self)
+
+  def __str__(self):
+    return self._view[self._start:self._end].tobytes()
@@ -0,0 +1,185 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Read from a slow (eg. decompressing) stream in a background thread.
+
+zlib and bz2 release the GIL while they work, so decompressing in one
+thread while parsing in another lets both run at once.
+"""
+
+import Queue
+import sys
+import threading
+import time
+
+DEFAULT_DEPTH = 4
+DEFAULT_BLOCKSIZE = 1024 * 1024
+
+_POLL_SECS = 0.5
+
+
+class Pipeline(object):
+  """Settings and statistics for one or more ThreadedReaders.
+
+  Attributes:
+    depth: the maximum number of blocks waiting in the queue.
+    blocksize: how many bytes to read from the stream at a time.
+    blocks, bytes: how much data went through the queue.
+    producer_stall_secs: time the reader thread spent waiting for the
+      queue to have space (ie. the consumer was the bottleneck).
+    consumer_stall_secs: time read() spent waiting for data (ie. the
+      stream was the bottleneck).
+  """
+
+  def __init__(self, depth=DEFAULT_DEPTH, blocksize=DEFAULT_BLOCKSIZE):
+    self.depth = depth
+    self.blocksize = blocksize
+    self.blocks = 0
+    self.bytes = 0
+    self.producer_stall_secs = 0.0
+    self.consumer_stall_secs = 0.0
+
+  def Wrap(self, stream):
+    """Return a ThreadedReader for stream using these settings."""
+    return ThreadedReader(stream, self)
+
+  def __repr__(self):
+    return ('Pipeline(depth=%d, blocksize=%d, blocks=%d, bytes=%d, '
+            'producer_stall_secs=%.3f, consumer_stall_secs=%.3f)'
+            % (self.depth, self.blocksize, self.blocks, self.bytes,
+               self.producer_stall_secs, self.consumer_stall_secs))
+
+
+def _Put(q, stop, pipeline, item):
+  """Put item in q; return false if we were stopped meanwhile."""
+  try:
+    q.put_nowait(item)
+    return True
+  except Queue.Full:
+    pass
+  start = time.time()
+  try:
+    while not stop.is_set():
+      try:
+        q.put(item, timeout=_POLL_SECS)
+        return True
+      except Queue.Full:
+        pass
+    return False
+  finally:
+    pipeline.producer_stall_secs += time.time() - start
+
+
+def _Produce(stream, q, stop, pipeline):
+  """The reader thread.  It doesn't refer to the ThreadedReader itself, so
+  that dropping the last reference to that stops us too."""
+  try:
+    try:
+      while not stop.is_set():
+        b = stream.read(pipeline.blocksize)
+        if not _Put(q, stop, pipeline, b) or not b:
+          break
+    except Exception:  # pylint: disable=broad-except
+      _Put(q, stop, pipeline, sys.exc_info())
+  except:  # pylint: disable=bare-except
+    # If the interpreter exits while we're still running, module globals
+    # turn into None under us, and there's nobody left to tell anyway.
+    if time is not None:
+      raise
+
+
+class ThreadedReader(object):
+  """A read-only file-like object filled from stream by a background thread.
+
+  Exceptions raised by the stream are re-raised from read().
+  """
+
+  def __init__(self, stream, pipeline=None):
+    self.stream = stream
+    self.name = getattr(stream, 'name', None)
+    self.pipeline = pipeline or Pipeline()
+    self.queue = Queue.Queue(self.pipeline.depth)
+    self.stop = threading.Event()
+    self.eof = False
+    self.outbuf = ''
+    self.outpos = 0
+    self.thread = threading.Thread(target=_Produce,
+                                   args=(stream, self.queue, self.stop,
+                                         self.pipeline))
+    self.thread.daemon = True
+    self.thread.start()
+
+  def __del__(self):
+    self.Stop()
+
+  def Stop(self):
+    """Stop the reader thread soon, but leave the stream open."""
+    self.stop.set()
+
+  def _Get(self):
+    try:
+      return self.queue.get_nowait()
+    except Queue.Empty:
+      pass
+    start = time.time()
+    try:
+      while 1:
+        # A timeout keeps us interruptible by KeyboardInterrupt.
+        try:
+          return self.queue.get(timeout=_POLL_SECS)
+        except Queue.Empty:
+          pass
+    finally:
+      self.pipeline.consumer_stall_secs += time.time() - start
+
+  def _NextBlock(self):
+    item = self._Get()
+    if isinstance(item, tuple):
+      self.eof = True
+      raise item[0], item[1], item[2]
+    if not item:
+      self.eof = True
+    else:
+      self.pipeline.blocks += 1
+      self.pipeline.bytes += len(item)
+    return item
+
+  def read(self, n=-1):
+    out = []
+    got = 0
+    while n < 0 or got < n:
+      if self.outpos >= len(self.outbuf):
+        if self.eof:
+          break
+        self.outbuf = self._NextBlock()
+        self.outpos = 0
+        if not self.outbuf:
+          break
+      want = len(self.outbuf) - self.outpos
+      if n >= 0:
+        want = min(want, n - got)
+      if not self.outpos and want == len(self.outbuf):
+        out.append(self.outbuf)
+      else:
+        out.append(self.outbuf[self.outpos:self.outpos + want])
+      self.outpos += want
+      got += want
+    return ''.join(out)
+
+  def close(self):
+    """Stop the reader thread, and close the stream once it has stopped."""
+    self.Stop()
+    self.thread.join(2 * _POLL_SECS)
+    if not self.thread.is_alive():
+      self.stream.close()
@@ -0,0 +1,272 @@
+#!/usr/bin/python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Generate synthetic radiotap pcap files, for benchmarking wifipacket.
+
+The traffic is a rough imitation of a busy access point: beacons with
+SSID and rate TLVs, QoS data at legacy, HT and VHT rates (each followed by
+its ACK), RTS/CTS exchanges, null data and probe requests, with a few
+percent of frames marked as having a bad FCS.  The same seed always gives
+the same bytes, so files made by different versions of the code can be
+compared directly.
+"""
+
+import bz2
+import gzip
+import random
+import struct
+import sys
+import options
+import wifipacket
+
+optspec = """
+synthpcap [options] <outfile.pcap>
+--
+n,packets=  Number of packets to generate (approximately) [100000]
+seed=       Random seed [1]
+z,compress  Also write outfile.pcap.gz and outfile.pcap.bz2
+"""
+
+_FLAG_FCS = wifipacket.Flags.FCS
+_FLAG_BAD_FCS = wifipacket.Flags.BAD_FCS
+_FCS = 'FCS!'
+
+
+def _Alignment(structformat):
+  """Radiotap fields are aligned to the size of their largest member."""
+  return max(struct.calcsize('<' + c) for c in structformat if c != 's')
+
+
+def Radiotap(fields, ext=False):
+  """Return a radiotap header containing the given fields.
+
+  Args:
+    fields: a dict of RADIOTAP_FIELDS name -> tuple of values.
+    ext: if true, add two (empty) extended presence bitmaps too.  That
+      keeps the fields 8-byte aligned relative to both the start of the
+      header and the end of the bitmaps, which is where
+      wifipacket.RadiotapDecoder measures alignment from.
+  Returns:
+    The header as a string.
+  """
+  present = 0
+  body = ''
+  hdrlen = 16 if ext else 8
+  for bit, (name, structformat) in enumerate(wifipacket.RADIOTAP_FIELDS):
+    if name not in fields:
+      continue
+    present |= 1 << bit
+    pad = -(hdrlen + len(body)) % _Alignment(structformat)
+    body += '\0' * pad + struct.pack('<' + structformat, *fields[name])
+  if ext:
+    present |= 1 << 31
+    return struct.pack('<BBHIII', 0, 0, hdrlen + len(body), present,
+                       1 << 31, 0) + body
+  return struct.pack('<BBHI', 0, 0, hdrlen + len(body), present) + body
+
+
+def _Mac(i):
+  return struct.pack('>HI', 0x0200 | (i >> 32), i & 0xffffffff)
+
+
+def _SeqCtl(seq):
+  return struct.pack('<H', seq << 4)
+
+
+class _Generator(object):
+  """Keeps the clocks and sequence numbers for Records()."""
+
+  def __init__(self, seed):
+    self.r = random.Random(seed)
+    self.secs = 1400000000.0
+    self.mac_usecs = 1000
+    self.seq = 0
+    self.aps = [_Mac(0x100 + i) for i in range(4)]
+    self.stas = [_Mac(0x200 + i) for i in range(20)]
+
+  def Advance(self, usecs):
+    self.secs += usecs / 1e6
+    self.mac_usecs += usecs
+
+  def Flags(self):
+    if self.r.random() < 0.03:
+      return _FLAG_FCS | _FLAG_BAD_FCS
+    return _FLAG_FCS
+
+  def Header(self, rate=None, ht=None, vht=None, antenna=False,
+             rx_flags=False, ext=False, flags=None):
+    fields = {
+        'mac_usecs': (self.mac_usecs,),
+        'flags': (self.Flags() if flags is None else flags,),
+        'channel': (5180, 0x140),
+        'dbm_antsignal': (self.r.randint(-80, -30),),
+        'dbm_antnoise': (-90,),
+    }
+    if rate is not None:
+      fields['rate'] = (rate,)
+    if antenna:
+      fields['antenna'] = (1,)
+    if rx_flags:
+      fields['rx_flags'] = (0,)
+    if ht is not None:
+      # known = bandwidth, mcs and guard interval
+      fields['ht'] = (0x07,) + ht
+    if vht is not None:
+      # known = bandwidth and guard interval; one user only
+      fields['vht'] = (0x44, 4, 4, chr(vht) + '\0\0\0', 0, 0, 0)
+    return Radiotap(fields, ext=ext)
+
+  def Beacon(self, ap):
+    r = self.r
+    i = self.aps.index(ap)
+    if i == 3:
+      ssid = ''  # a hidden network
+    else:
+      ssid = 'ssid%d' % i
+    tlvs = ('\x00' + chr(len(ssid)) + ssid +
+            '\x01\x04\x82\x84\x8b\x96' +
+            '\x03\x01\x24')
+    frame = (struct.pack('<HH', 0x0080, 0) + '\xff' * 6 + ap + ap +
+             _SeqCtl(self.seq) +
+             struct.pack('<QHH', self.mac_usecs, 100, 0x0401) +
+             tlvs + _FCS)
+    return [(self.secs, self.Header(rate=2, antenna=r.random() < 0.5) +
+             frame)]
+
+  def Data(self, ap, sta):
+    """A QoS data frame, and the ACK that follows it."""
+    r = self.r
+    up = r.random() < 0.5
+    fctl = 0x0088 | (0x0100 if up else 0x0200)
+    if r.random() < 0.1:
+      fctl |= 0x0800  # retry
+    a1, a2 = (ap, sta) if up else (sta, ap)
+    payload = 'x' * r.randint(20, 1500)
+    frame = (struct.pack('<HH', fctl, 44) + a1 + a2 + ap +
+             _SeqCtl(self.seq) + '\0\0' + payload + _FCS)
+    kind = r.random()
+    if kind < 0.2:
+      hdr = self.Header(rate=r.choice([12, 24, 48, 108]))
+    elif kind < 0.6:
+      hdr = self.Header(ht=(r.randint(0, 7), r.randint(0, 15)),
+                        rx_flags=True)
+    else:
+      mcs_nss = r.randint(1, 2) | (r.randint(0, 9) << 4)
+      hdr = self.Header(vht=mcs_nss, ext=r.random() < 0.3)
+    out = [(self.secs, hdr + frame)]
+    self.Advance(r.randint(30, 60))
+    ack = struct.pack('<HH', 0x00d4, 0) + a2 + _FCS
+    out.append((self.secs, self.Header(rate=12, flags=_FLAG_FCS) + ack))
+    return out
+
+  def RtsCts(self, ap, sta):
+    rts = struct.pack('<HH', 0x00b4, 100) + ap + sta + _FCS
+    out = [(self.secs, self.Header(rate=12) + rts)]
+    self.Advance(30)
+    cts = struct.pack('<HH', 0x00c4, 0) + sta + _FCS
+    out.append((self.secs, self.Header(rate=12, flags=_FLAG_FCS) + cts))
+    return out
+
+  def NullData(self, ap, sta):
+    frame = (struct.pack('<HH', 0x0148, 0) + ap + sta + ap +
+             _SeqCtl(self.seq) + _FCS)
+    hdr = self.Header(rate=self.r.choice([2, 12, 48, 108]),
+                      antenna=True, rx_flags=True)
+    return [(self.secs, hdr + frame)]
+
+  def ProbeRequest(self, unused_ap, sta):
+    frame = (struct.pack('<HH', 0x0040, 0) + '\xff' * 6 + sta + '\xff' * 6 +
+             _SeqCtl(self.seq) + '\x00\x00' + '\x01\x04\x82\x84\x8b\x96' +
+             _FCS)
+    return [(self.secs, self.Header(rate=2) + frame)]
+
+  def Next(self):
+    """Return a list of (pcap_secs, frame) that belong together."""
+    r = self.r
+    self.Advance(r.randint(10, 2000))
+    self.seq = (self.seq + 1) & 0xfff
+    ap = r.choice(self.aps)
+    sta = r.choice(self.stas)
+    kind = r.random()
+    if kind < 0.2:
+      return self.Beacon(ap)
+    elif kind < 0.7:
+      return self.Data(ap, sta)
+    elif kind < 0.8:
+      return self.RtsCts(ap, sta)
+    elif kind < 0.9:
+      return self.NullData(ap, sta)
+    else:
+      return self.ProbeRequest(ap, sta)
+
+
+def Records(npackets, seed=1):
+  """Yield about npackets (pcap_secs, radiotap frame) pairs."""
+  g = _Generator(seed)
+  n = 0
+  while n < npackets:
+    for record in g.Next():
+      yield record
+      n += 1
+
+
+def Write(f, records):
+  """Write records from Records() to file f as a pcap file."""
+  f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535,
+                      wifipacket.LINKTYPE_IEEE802_11_RADIOTAP))
+  for secs, frame in records:
+    isecs = int(secs)
+    usecs = int(round((secs - isecs) * 1e6))
+    if usecs >= 1000000:
+      isecs += 1
+      usecs -= 1000000
+    f.write(struct.pack('<IIII', isecs, usecs, len(frame), len(frame)))
+    f.write(frame)
+
+
+def WriteCaptures(filename, npackets, seed=1, compress=True):
+  """Write filename, and (if compress) filename.gz and filename.bz2.
+
+  Returns:
+    The list of file names written.
+  """
+  names = [filename]
+  with open(filename, 'wb') as f:
+    Write(f, Records(npackets, seed))
+  if compress:
+    with open(filename, 'rb') as f:
+      data = f.read()
+    for suffix, opener in (('.gz', gzip.GzipFile), ('.bz2', bz2.BZ2File)):
+      out = opener(filename + suffix, 'wb')
+      try:
+        out.write(data)
+      finally:
+        out.close()
+      names.append(filename + suffix)
+  return names
+
+
+def main():
+  o = options.Options(optspec)
+  opt, unused_flags, extra = o.parse(sys.argv[1:])
+  if len(extra) != 1:
+    o.fatal('exactly one output file name expected')
+  for name in WriteCaptures(extra[0], opt.packets, seed=opt.seed,
+                            compress=opt.compress):
+    print name
+
+
+if __name__ == '__main__':
+  main()
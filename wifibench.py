@@ -0,0 +1,323 @@
+#!/usr/bin/python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure how fast wifipacket can parse a given capture file.
+
+Each benchmark runs in its own child process, so we can report its peak
+memory use too.  With --synth, we also run on a synthetic capture (see
+synthpcap.py) that is the same from one run to the next, and --json saves
+the results so that runs on different commits can be compared.
+"""
+
+import gzip
+import json
+import os
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import airflow
+import colcache
+import mybuf
+import options
+import synthpcap
+import wifipacket
+
+optspec = """
+wifibench [options] <pcapfiles...>
+--
+r,repeat=   Number of times to run each benchmark (best time is used) [3]
+b,bench=    Comma-separated list of benchmarks to run [all]
+s,synth=    Also run on a synthetic capture of this many packets (+gz, bz2)
+j,json=     Write the results to this file as JSON
+"""
+
+
+def _Open(fn):
+  """Like wifipacket.ZOpen, but also decompress .gz files.
+
+  (Packetize() notices gzip data by itself, but the lower layers don't.)
+  """
+  if fn.endswith('.gz'):
+    return gzip.GzipFile(fn, 'rb')
+  return wifipacket.ZOpen(fn)
+
+
+def _Full(fn, fields=None):
+  """Parse every packet and decode every field."""
+  n = 0
+  for p, unused_frame in wifipacket.Packetize(wifipacket.ZOpen(fn),
+                                              fields=fields):
+    p.keys()
+    n += 1
+  return n
+
+
+def _Boxes(fn, fields=None, packets=None):
+  """Count packets per MAC address, like app._Boxes."""
+  n = 0
+  boxes = {}
+  if packets is None:
+    packets = wifipacket.Packetize(wifipacket.ZOpen(fn), fields=fields)
+  for p, unused_frame in packets:
+    n += 1
+    if 'flags' in p and p.flags & wifipacket.Flags.BAD_FCS: continue
+    if 'ta' in p and 'ra' in p:
+      boxes[p.ta] = boxes.get(p.ta, 0) + 1
+      boxes[p.ra] = boxes.get(p.ra, 0) + 1
+  return n
+
+
+def _Airflow(fn, fields=None):
+  """Add up airtime per column and transmitters per row, like airflow.py."""
+  n = 0
+  col_start_usec = row_start_usec = None
+  mac_usecs = col_airtime = 0
+  cols = []
+  row_macs = set()
+  for p, unused_frame in wifipacket.Packetize(wifipacket.ZOpen(fn),
+                                              fields=fields):
+    n += 1
+    if p.type & 0xf0 == 0x10:
+      continue
+    mac_usecs = p.get('mac_usecs', mac_usecs)
+    if col_start_usec is None:
+      col_start_usec = row_start_usec = mac_usecs
+    while mac_usecs - col_start_usec >= airflow.USEC_PER_COL:
+      cols.append(col_airtime)
+      col_airtime = 0
+      col_start_usec += airflow.USEC_PER_COL
+      if col_start_usec - row_start_usec >= airflow.USEC_PER_ROW:
+        row_start_usec = col_start_usec
+        row_macs.clear()
+    col_airtime += p.get('airtime_usec', 0)
+    if not p.get('flags', 0) & wifipacket.Flags.BAD_FCS:
+      row_macs.add(p.get('ta'))
+      if p.type == 0x08:
+        p.get('ssid')
+  return n
+
+
+def _Packetizer(fn, fields=None):
+  """Feed the file to a Packetizer in 64k pieces, like wifitop does."""
+  counter = [0]
+  def Got(unused_opt, unused_frame):
+    counter[0] += 1
+  p = wifipacket.Packetizer(Got, fields=fields)
+  f = _Open(fn)
+  while 1:
+    b = f.read(65536)
+    if not b:
+      break
+    p.Handle(b)
+  return counter[0]
+
+
+def _Parser(fn, fields=None):
+  """Run PcapParser directly over 1MB pieces of the file."""
+  parser = wifipacket.PcapParser(fields)
+  f = _Open(fn)
+  n = 0
+  data = ''
+  while 1:
+    b = f.read(1024 * 1024)
+    if not b:
+      break
+    data += b
+    out = []
+    data = data[parser.Parse(data, out):]
+    n += len(out)
+  return n
+
+
+def _BuildCache(fn, tmpdir):
+  """Build fn's column cache in tmpdir, rather than next to fn."""
+  fd, filename = tempfile.mkstemp(suffix='.cols', dir=tmpdir)
+  os.close(fd)
+  colcache.BuildCache(fn, filename=filename)
+  return filename
+
+
+def _BoxesCache(filename):
+  """Like _Boxes, but read from a column cache made by _BuildCache."""
+  cache = colcache.ColumnCache.Load(filename)
+  return _Boxes(None, packets=cache.Packetize(BOXES_FIELDS))
+
+
+def _BufRecords(fn, bufclass, blocksize=65536):
+  """Split the file into pcap records through a mybuf queue.
+
+  This is what reading from a pipe, blocksize bytes at a time, would do.
+  """
+  f = _Open(fn)
+  buf = bufclass()
+  fill = getattr(buf, 'Fill', None)
+  incl_len = None
+  n = 0
+  while 1:
+    if fill:
+      got = fill(f, blocksize)
+    else:
+      b = f.read(blocksize)
+      buf.Put(b)
+      got = len(b)
+    if incl_len is None and buf.used >= 24:
+      byteorder = wifipacket.PcapByteOrder(bytes(buf.Get(24)[:4]))
+      incl_len = struct.Struct(byteorder + 'I')
+    while incl_len and buf.used >= 16:
+      size = 16 + incl_len.unpack_from(buf.Peek(16), 8)[0]
+      if buf.used < size:
+        break
+      buf.Get(size)
+      n += 1
+    if not got:
+      return n
+
+
+# Same as app.BOXES_FIELDS; app itself can only be imported under appengine.
+BOXES_FIELDS = ['flags', 'ta', 'ra']
+
+BENCHMARKS = [
+    ('full', _Full),
+    ('boxes', _Boxes),
+    ('boxes-fields', lambda fn: _Boxes(fn, fields=BOXES_FIELDS)),
+    ('boxes-cache', _BoxesCache),
+    ('airflow', _Airflow),
+    ('airflow-fields', lambda fn: _Airflow(fn, fields=airflow.FIELDS)),
+    ('packetizer', lambda fn: _Packetizer(fn, fields=BOXES_FIELDS)),
+    ('parser', lambda fn: _Parser(fn, fields=BOXES_FIELDS)),
+    ('buf', lambda fn: _BufRecords(fn, mybuf.Buf)),
+    ('ringbuf', lambda fn: _BufRecords(fn, mybuf.RingBuf)),
+    ('buf-4k', lambda fn: _BufRecords(fn, mybuf.Buf, 4096)),
+    ('ringbuf-4k', lambda fn: _BufRecords(fn, mybuf.RingBuf, 4096)),
+]
+
+# Benchmark name -> setup(fn, tmpdir), which prepares the argument to pass
+# to the benchmark instead of fn.  It runs once, and isn't timed.
+SETUPS = {
+    'boxes-cache': _BuildCache,
+}
+
+
+def Run(func, fn, repeat):
+  """Run func(fn) repeat times; return (packets, best_seconds)."""
+  best = None
+  for _ in xrange(repeat):
+    start = time.time()
+    n = func(fn)
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return n, best
+
+
+def RunForked(func, fn, repeat):
+  """Like Run(), but in a child process so we can see its peak RSS.
+
+  Returns:
+    (packets, best_seconds, peak_rss_kbytes).  Without fork(), the RSS is
+    that of this whole process so far.
+  """
+  if not hasattr(os, 'fork'):
+    n, secs = Run(func, fn, repeat)
+    return n, secs, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  r, w = os.pipe()
+  pid = os.fork()
+  if not pid:
+    status = 1
+    try:
+      os.close(r)
+      os.write(w, json.dumps(Run(func, fn, repeat)))
+      status = 0
+    except Exception:  # pylint: disable=broad-except
+      traceback.print_exc()
+    finally:
+      os._exit(status)  # pylint: disable=protected-access
+  os.close(w)
+  got = []
+  while 1:
+    b = os.read(r, 65536)
+    if not b:
+      break
+    got.append(b)
+  os.close(r)
+  unused_pid, status, usage = os.wait4(pid, 0)
+  if status or not got:
+    raise Exception('%s on %s: child failed with status %d' %
+                    (func.__name__, fn, status))
+  n, secs = json.loads(''.join(got))
+  return n, secs, usage.ru_maxrss
+
+
+def _Commit():
+  """Return the git commit this code came from, or None if unknown."""
+  try:
+    p = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                         stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+  except OSError:
+    return None
+  out = p.communicate()[0].strip()
+  return out if not p.returncode and out else None
+
+
+def main():
+  o = options.Options(optspec)
+  opt, unused_flags, extra = o.parse(sys.argv[1:])
+  if not extra and not opt.synth:
+    o.fatal('at least one pcap file name (or --synth) expected')
+  if opt.bench == 'all':
+    benchmarks = BENCHMARKS
+  else:
+    want = opt.bench.split(',')
+    benchmarks = [(name, func) for name, func in BENCHMARKS if name in want]
+    if len(benchmarks) != len(want):
+      o.fatal('unknown benchmark in %r' % opt.bench)
+  files = [(fn, fn) for fn in extra]
+  tmpdir = tempfile.mkdtemp(prefix='wifibench.')
+  if opt.synth:
+    for fn in synthpcap.WriteCaptures(os.path.join(tmpdir, 'synth.pcap'),
+                                      opt.synth):
+      files.append((fn, '%s(%d)' % (os.path.basename(fn), opt.synth)))
+  results = []
+  try:
+    for fn, label in files:
+      for name, func in benchmarks:
+        setup = SETUPS.get(name)
+        arg = setup(fn, tmpdir) if setup else fn
+        n, secs, rss = RunForked(func, arg, opt.repeat)
+        pps = n / secs if secs else 0
+        print '%-20s %-30s %9d pkts %8.3fs %10.0f pkts/s %6.1f MB' % (
+            name, label, n, secs, pps, rss / 1024.0)
+        sys.stdout.flush()
+        results.append(dict(bench=name, file=label, packets=n, secs=secs,
+                            packets_per_sec=pps, peak_rss_kbytes=rss))
+  finally:
+    shutil.rmtree(tmpdir)
+  if opt.json:
+    with open(opt.json, 'w') as f:
+      json.dump(dict(commit=_Commit(), time=time.time(),
+                     python=sys.version.split()[0], repeat=opt.repeat,
+                     synth=opt.synth, results=results),
+                f, indent=2, sort_keys=True)
+      f.write('\n')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Write seek index sidecar files for pcap captures."""
+
+import sys
+import colcache
+import gzseek
+import options
+import wifipacket
+
+optspec = """
+wifiindex [options] <pcapfiles...>
+--
+n,interval=  Index every n'th packet [1000]
+s,span=      For gzip files, save a checkpoint every this many bytes [1048576]
+c,columns    Also save a column cache of the decoded packets (see colcache.py)
+"""
+
+
+def main():
+  o = options.Options(optspec)
+  opt, unused_flags, extra = o.parse(sys.argv[1:])
+  if not extra:
+    o.fatal('at least one pcap file name expected')
+  if opt.columns and not colcache.Available():
+    o.fatal('--columns needs numpy')
+  for fn in extra:
+    index = wifipacket.BuildIndex(fn, interval=opt.interval)
+    print '%s: %d entries' % (wifipacket.IndexFilename(fn),
+                              len(index.entries))
+    with open(fn, 'rb') as f:
+      is_gzip = f.read(3) == wifipacket.GZIP_MAGIC
+    if is_gzip:
+      if not gzseek.Available():
+        sys.stderr.write('%s: gzip random access not available here\n' % fn)
+      else:
+        gzindex = gzseek.BuildIndex(fn, span=opt.span)
+        print '%s: %d checkpoints' % (gzseek.IndexFilename(fn),
+                                      len(gzindex.points))
+    if opt.columns:
+      cache = colcache.BuildCache(fn)
+      print '%s: %d packets in %d chunks' % (colcache.CacheFilename(fn),
+                                             len(cache), len(cache.chunks))
+
+
+if __name__ == '__main__':
+  main()
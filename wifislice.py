@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Copy a time window and/or some stations' packets out of a pcap file."""
+
+import sys
+import options
+import wifipacket
+
+optspec = """
+wifislice [options] <pcapfile>
+--
+o,output=    Write the new pcap file here (default: stdout)
+s,start=     Start time (epoch seconds, or +secs after the first packet)
+e,end=       End time (epoch seconds, or +secs after the start time)
+m,mac=       Only packets with this MAC address as the TA or RA
+f,filter=    Only packets matching this wifipacket.Prefilter expression
+"""
+
+
+def _FirstSecs(fn):
+  for opt, unused_frame in wifipacket.Packetize(wifipacket.ZOpen(fn),
+                                                fields=['pcap_secs']):
+    return opt.pcap_secs
+  return 0
+
+
+def main():
+  o = options.Options(optspec)
+  opt, unused_flags, extra = o.parse(sys.argv[1:])
+  if len(extra) != 1:
+    o.fatal('exactly one pcap file name expected')
+  fn = extra[0]
+
+  start_time = end_time = None
+  try:
+    if opt.start:
+      start = str(opt.start)
+      if start.startswith('+'):
+        start_time = _FirstSecs(fn) + float(start[1:])
+      else:
+        start_time = float(start)
+    if opt.end:
+      end = str(opt.end)
+      if end.startswith('+'):
+        end_time = ((start_time if start_time is not None else _FirstSecs(fn))
+                    + float(end[1:]))
+      else:
+        end_time = float(end)
+  except ValueError, e:
+    o.fatal('invalid time: %s' % e)
+
+  exprs = []
+  if opt.mac:
+    exprs.append('ta == %s or ra == %s' % (opt.mac, opt.mac))
+  if opt.filter:
+    exprs.append(opt.filter)
+  prefilter = None
+  if exprs:
+    try:
+      prefilter = wifipacket.Prefilter(
+          ' and '.join('(%s)' % expr for expr in exprs))
+    except wifipacket.FilterError, e:
+      o.fatal(str(e))
+
+  out = open(opt.output, 'wb') if opt.output else sys.stdout
+  count = wifipacket.SliceCapture(fn, out, start_time, end_time, prefilter)
+  out.close()
+  sys.stderr.write('%s: %d packets\n' % (opt.output or '(stdout)', count))
+
+
+if __name__ == '__main__':
+  main()
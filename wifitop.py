@@ -30,11 +30,18 @@ import wifipacket
 optspec = """
 wifitop [options]
 --
-i,ifc=       Network interface to use [en0]
+i,ifc=       Network interface(s) to use, separated by commas [en0]
 tcpdump=     tcpdump command line [tcpdump -w - -Ilni {ifc}]
 """
 
 
+# Packet fields used by _GotPacket().
+FIELDS = ['bad', 'typestr', 'dsmode', 'type', 'ta', 'ra', 'mcs',
+          'dbm_antsignal', 'ssid']
+
+# Deliver packets in batches, at most this many seconds late.
+BATCH_LATENCY = 0.05
+
 RATE_BIN_MAX = 9
 RATE_BIN_SHOW_MAX = 7
 
@@ -45,6 +52,7 @@ unknowncount = None
 controlcount = None
 stations = None
 aliases = None
+macs = None
 
 
 class StationData(object):
@@ -98,58 +106,67 @@ def RateArt(bins, maxbin):
 
 
 def _IsMcast(sta_mac):
-  return sta_mac and int(sta_mac[0:2], 16) & 1
+  return sta_mac is not None and macs.IsMulticast(sta_mac)
 
 
-def _GotPacket(opt, unused_frame):
+def _GotPackets(packets):
+  """Update stations and the global counters from a batch of packets."""
   global pcount, badcount, unknowncount, controlcount
-  pcount += 1
-  if opt.bad:
-    badcount += 1
-  if opt.typestr[0] == '1':
-    # control traffic is uninteresting for now
-    controlcount += 1
+  pcount += len(packets)
+  now = time.time()
+  for opt, unused_frame in packets:
+    if opt.bad:
+      badcount += 1
+    if opt.typestr[0] == '1':
+      # control traffic is uninteresting for now
+      controlcount += 1
+    elif _GotPacket(opt, now) is False:
+      unknowncount += 1
+
+
+def _GotPacket(opt, now):
+  """Update stations from one non-control packet.
+
+  Returns False if it was a bad packet from an unknown station.
+  """
+  if opt.dsmode == 2 or (opt.dsmode == 0 and opt.type == 0x08):
+    down = True
+    ap_mac, sta_mac = opt.get('ta', None), opt.get('ra', None)
+  elif opt.dsmode == 1:
+    down = False
+    sta_mac, ap_mac = opt.get('ta', None), opt.get('ra', None)
   else:
-    if opt.dsmode == 2 or (opt.dsmode == 0 and opt.type == 0x08):
-      down = True
-      ap_mac, sta_mac = opt.get('ta', None), opt.get('ra', None)
-    elif opt.dsmode == 1:
-      down = False
-      sta_mac, ap_mac = opt.get('ta', None), opt.get('ra', None)
+    # dsmode 0 is unclear whether AP or STA; ignore for now.
+    return
+  if opt.bad and ap_mac not in stations:
+    return False
+  ap_arr = stations[ap_mac]
+  ap = ap_arr[None]
+  if opt.bad and sta_mac not in ap_arr:
+    return False
+  sta = ap_arr[sta_mac]
+  if opt.typestr[0] == '2':  # only care about data rates
+    rate_bin = min(opt.get('mcs', 0), RATE_BIN_MAX)
+    if down:
+      ap.packets_tx[rate_bin] += 1
+      sta.packets_rx[rate_bin] += 1
     else:
-      # dsmode 0 is unclear whether AP or STA; ignore for now.
-      return
-    if opt.bad and ap_mac not in stations:
-      unknowncount += 1
-      return
-    ap_arr = stations[ap_mac]
-    ap = ap_arr[None]
-    if opt.bad and sta_mac not in ap_arr:
-      unknowncount += 1
-      return
-    sta = ap_arr[sta_mac]
-    if opt.typestr[0] == '2':  # only care about data rates
-      rate_bin = min(opt.get('mcs', 0), RATE_BIN_MAX)
-      if down:
-        ap.packets_tx[rate_bin] += 1
-        sta.packets_rx[rate_bin] += 1
-      else:
-        ap.packets_rx[rate_bin] += 1
-        sta.packets_tx[rate_bin] += 1
-    if 'dbm_antsignal' in opt:
-      if down:
-        ap.rssi[opt.dbm_antsignal] += 1
-      else:
-        sta.rssi[opt.dbm_antsignal] += 1
-    if down and opt.typestr == '08 Beacon':
-      ap.is_ap = True
-      ssid = opt.get('ssid')
-      if ssid:
-        ssid = re.sub(r'[^\w]', '.', ssid)
-        aliases.BetterGuess(ap_mac, ssid)
-    if opt.typestr not in ('08 Beacon', '24 Null'):
-      sta.last_updated = ap.last_updated = time.time()
-      sta.last_type = ap.last_type = opt.typestr
+      ap.packets_rx[rate_bin] += 1
+      sta.packets_tx[rate_bin] += 1
+  if 'dbm_antsignal' in opt:
+    if down:
+      ap.rssi[opt.dbm_antsignal] += 1
+    else:
+      sta.rssi[opt.dbm_antsignal] += 1
+  if down and opt.typestr == '08 Beacon':
+    ap.is_ap = True
+    ssid = opt.get('ssid')
+    if ssid:
+      ssid = re.sub(r'[^\w]', '.', ssid)
+      aliases.BetterGuess(macs.Format(ap_mac), ssid)
+  if opt.typestr not in ('08 Beacon', '24 Null'):
+    sta.last_updated = ap.last_updated = now
+    sta.last_type = ap.last_type = opt.typestr
 
 
 def _APSortKey((unused_mac, stationlist)):
@@ -158,12 +175,13 @@ def _APSortKey((unused_mac, stationlist)):
 
 
 def _STASortKey((mac, sta)):
-  return (not not mac) - sum(sta.packets_tx)-sum(sta.packets_rx)
+  return (mac is not None) - sum(sta.packets_tx)-sum(sta.packets_rx)
 
 
 def _CursesMain(win, ifc, tcpdump):
   """This function is called inside a curses initscr() activity."""
-  global stations, aliases, pcount, badcount, unknowncount, controlcount
+  global stations, aliases, macs
+  global pcount, badcount, unknowncount, controlcount
   pcount = badcount = unknowncount = controlcount = 0
   use_aliases = True
   show_mcast = False
@@ -171,19 +189,21 @@ def _CursesMain(win, ifc, tcpdump):
   aliases = ieee_oui.Aliases(os.path.expanduser('~/.ether_aliases'), oui)
   stations = collections.defaultdict(
       lambda: collections.defaultdict(StationData))
-  tcpdump_argv = [i.format(ifc=ifc) for i in tcpdump.split()]
-  p = subprocess.Popen(tcpdump_argv,
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  # Keep MAC addresses as integers, and only format the ones we display.
+  macs = wifipacket.MacTable('int')
   streams = []
   stderr_log = []
-  streams.append((os.dup(p.stdout.fileno()),
-                  os.dup(p.stderr.fileno()),
-                  wifipacket.Packetizer(_GotPacket)))
-  # TODO(apenwarr): use multi-stream support for something.
-  #   The idea is we can listen to multiple tcpdump instances at once (eg.
-  #   if there are multiple wifi interfaces).
-  # streams.append((os.open('foo.pcap', os.O_RDONLY),
-  #                wifipacket.Packetizer(_GotPacket)))
+  # One tcpdump per wifi interface.  We only count packets, so they don't
+  # need to be merged into timestamp order (see wifipacket.PacketMerger).
+  for one_ifc in ifc.split(','):
+    tcpdump_argv = [i.format(ifc=one_ifc) for i in tcpdump.split()]
+    p = subprocess.Popen(tcpdump_argv,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    streams.append((os.dup(p.stdout.fileno()),
+                    os.dup(p.stderr.fileno()),
+                    wifipacket.BatchPacketizer(_GotPackets, fields=FIELDS,
+                                               max_latency=BATCH_LATENCY,
+                                               macs=macs)))
 
   last_update = 0
   win.nodelay(True)
@@ -256,7 +276,7 @@ def _CursesMain(win, ifc, tcpdump):
           rssi_count = 1 + sum(count
                                for (rssi, count) in stats.rssi.iteritems())
           rssi_avg = rssi_sum / rssi_count
-          is_ap = 0 if sta_mac else 1
+          is_ap = 0 if sta_mac is not None else 1
           if not is_ap and not ap.is_expanded:
             continue
           down_packets = stats.packets_tx if is_ap else stats.packets_rx
@@ -266,11 +286,11 @@ def _CursesMain(win, ifc, tcpdump):
             continue
           if is_mcast:
             typ = '   *'
-          elif sta_mac:
+          elif sta_mac is not None:
             typ = '   '
           else:
             typ = ' AP ' if stats.is_expanded else '+AP '
-          mac = sta_mac or ap_mac
+          mac = macs.Format(ap_mac if sta_mac is None else sta_mac)
           nice_mac = mac
           try:
             nice_mac = aliases.Get(mac)
@@ -327,7 +347,10 @@ def _CursesMain(win, ifc, tcpdump):
             stderr_log.append(b)
             if not b:
               # EOF
+              packetizer.Flush()
               streams.remove((streamout, streamerr, packetizer))
+    for unused_streamout, unused_streamerr, packetizer in streams:
+      packetizer.Poll()
   return stderr_log
 
 